@@ -5,4 +5,13 @@ particle distributions.
 .. moduleauthor:: Michael O'Brien <michaelobrien@g.harvard.edu>
 """
 
-from .particle_correlations import corr, multipoles, fourier_multipoles
+import spatialstats
+
+from .particle_correlations import multipoles, fourier_multipoles
+
+if spatialstats.config.gpu is False:
+    from .particle_correlations import corr
+else:
+    from .cuda_particle_correlations import corr
+
+del spatialstats
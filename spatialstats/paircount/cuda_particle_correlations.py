@@ -0,0 +1,261 @@
+"""
+Implementation using CuPy acceleration.
+
+.. moduleauthor:: Michael O'Brien <michaelobrien@g.harvard.edu>
+
+"""
+
+import numpy as np
+import cupy as cp
+from time import time
+
+from .particle_correlations import _get_distribution
+
+
+def corr(positions, boxsize, weights=None, z=1, orientations=None, rmin=None, rmax=None,
+         nr=100, nphi=None, ntheta=None, cos=True, int=np.int32, float=np.float32,
+         blocksize=2048, bench=False):
+    """
+    See the documentation for the :ref:`CPU version<corr>`.
+
+    Pairs are found by a brute force search over
+    tiles of ``blocksize`` by ``blocksize`` particles,
+    so memory requirements on the GPU are bounded
+    by ``blocksize`` rather than the number of pairs.
+
+    Parameters
+    ----------
+    positions : `np.ndarray`, shape `(N, ndim)`
+        Particle positions :math:`\\mathbf{r}_i`
+        in 2D or 3D for :math:`N` particles.
+    boxsize : `list` of `float`
+        The rectangular domain over which
+        to apply periodic boundary conditions.
+    weights : `np.ndarray`, shape `(N, ndim)`, optional
+        Particle vectors :math:`\\mathbf{w}_i` over which
+        to calculate pair correlation function.
+    z : `int`
+        Exponent in averaging
+        :math:`\\langle (\\mathbf{w}_i \\cdot \\mathbf{w}_j)^z \\rangle`.
+    orientations : `np.ndarray`, shape `(N, ndim)`, optional
+        Particle orientation vectors :math:`\\mathbf{p}_i`.
+    rmin : `float`, optional
+        Minimum :math:`r` value in :math:`g(r, \\phi, \\theta)`.
+    rmax : `float`, optional
+        Cutoff radius and maximum :math:`r` value
+        in :math:`g(r, \\phi, \\theta)`.
+        Default is half the maximum dimension of ``boxsize``.
+    nr : `int`, optional
+        Number of points to bin in :math:`r`.
+    nphi : `int`, optional
+        Number of points to bin in :math:`\\phi`.
+    ntheta : `int`, optional
+        Number of points to bin in :math:`\\cos\\theta` or :math:`\\theta`.
+    cos : `bool`, optional
+        Choose whether to bin in slices of :math:`\\cos\\theta`
+        or :math:`\\theta`. Default is :math:`\\cos\\theta`.
+    int : `np.dtype`, optional
+        Integer type for pair index arrays.
+    float : `np.dtype`, optional
+        Floating-point type for computing pair displacements.
+        Differences of positions are taken in double precision,
+        so single precision only rounds the small displacements.
+    blocksize : `int`, optional
+        Number of particles per tile in the pair search.
+        Lower to save memory.
+    bench : `bool`, optional
+        Print message for time of calculation.
+
+    Returns
+    -------
+    g : `np.ndarray`, shape `(nr, nphi, ntheta)`
+        Radial distribution function :math:`G(r, \\phi, \\cos\\theta)`.
+    r : `np.ndarray`, shape `(nr,)`
+        Left edges of radial bins :math:`r`.
+    phi : `np.ndarray`, shape `(nphi,)`
+        Left edges of angular bins :math:`\\phi \\in [-\\pi, \\pi)`.
+    theta : `np.ndarray`, shape `(ntheta,)`
+        Left edges of angular bins :math:`\\theta \\in [0, \\pi)`
+        or :math:`\\cos\\theta \\in [-1, 1)`.
+        Not returned for 2D datasets.
+    vol : `np.ndarray`, shape ``g.shape``
+        Bin volume used to normalize :math:`G`.
+    """
+    N, ndim = positions.shape
+    boxsize = np.array(boxsize)
+
+    if ndim not in [2, 3]:
+        raise ValueError("Dimension of space must be 2 or 3")
+
+    if N > np.iinfo(int).max:
+        msg = f"Number of particles {N} overflows pair index type {np.dtype(int)}"
+        raise ValueError(msg)
+
+    if orientations is not None and orientations.shape != (N, ndim):
+        msg = f"Shape of orientations must match positions array {(N, ndim)}"
+        raise ValueError(msg)
+    if weights is not None and weights.shape != (N, ndim):
+        msg = f"Shape of weights must match positions array {(N, ndim)}"
+        raise ValueError(msg)
+
+    # Binning keyword args
+    rmin = 0 if rmin is None else rmin
+    rmax = max(boxsize)/2 if rmax is None else rmax
+    nr = 1 if nr is None or nr < 1 else nr
+    nphi = 1 if nphi is None or nphi < 1 else nphi
+    ntheta = 1 if ntheta is None or ntheta < 1 or ndim == 2 else ntheta
+
+    # Bin edges
+    r_n = np.linspace(rmin, rmax, nr+1)
+    phi_m = 2*np.pi*np.linspace(0, 1, nphi+1) - np.pi
+    theta_l = np.linspace(-1, 1, ntheta+1) if cos else np.pi*np.linspace(0, 1, ntheta+1)
+
+    if bench:
+        t0 = time()
+
+    # Get memory pools
+    mempool = cp.get_default_memory_pool()
+    pinned_mempool = cp.get_default_pinned_memory_pool()
+
+    # Move data to the GPU. Minimum image
+    # displacements don't need coords in the box.
+    box = cp.asarray(boxsize, dtype=cp.float64)
+    pos = cp.asarray(positions, dtype=cp.float64)
+    w = None if weights is None else cp.asarray(weights, dtype=float)
+    rot = None if orientations is None else \
+        _get_rotations(cp.asarray(orientations, dtype=float))
+
+    # Search tiles of particle pairs and bin displacements
+    count = cp.zeros(nr*nphi*ntheta, dtype=cp.float64)
+    npairs = 0
+    for a in range(0, N, blocksize):
+        for b in range(a, N, blocksize):
+            i, j, r_ij = _get_pairs(pos, box, rmax, a, b, blocksize, int, float)
+            npairs += i.size
+            if i.size == 0:
+                continue
+            w_ij = None if w is None else cp.sum(w[i]*w[j], axis=1)**z
+            # Reverse pair (j, i) has displacement -r_ij
+            for origin, r_o in ((i, r_ij), (j, -r_ij)):
+                if rot is not None:
+                    # Rotate particle head to +z direction
+                    r_o = _rotate(rot[origin], r_o)
+                bins = _get_bins(r_o, r_n, phi_m, theta_l, cos)
+                inside = bins >= 0
+                if not inside.any():
+                    # cp.bincount fails on empty input
+                    continue
+                count += cp.bincount(bins[inside], minlength=count.size,
+                                     weights=None if w_ij is None else w_ij[inside])
+            del i, j, r_ij, w_ij, r_o, bins, inside
+
+    if npairs == 0:
+        raise ValueError(f"Counted 0 pairs. Try increasing rmax")
+
+    if bench:
+        t1 = time()
+        print(f"Counted and binned {npairs} pairs: {t1-t0:.04f} s")
+
+    count = count.get().reshape((nr, nphi, ntheta))
+
+    del pos, box, w, rot
+    mempool.free_all_blocks()
+    pinned_mempool.free_all_blocks()
+
+    # Get correlation function
+    g, vol = _get_distribution(count, N, boxsize, r_n, phi_m, theta_l, cos)
+
+    out = [g, r_n[:-1], phi_m[:-1]]
+    if ndim == 3:
+        out.append(theta_l[:-1])
+    out.append(vol)
+
+    return tuple(out)
+
+
+def _get_pairs(pos, box, rmax, a, b, blocksize, int, float):
+    '''
+    Get pairs (i<j) within distance rmax between the tiles
+    of particles starting at a and b, and their minimum
+    image displacements. Differences are taken in the
+    precision of pos and then rounded to float.
+    '''
+    r_a, r_b = pos[a:a+blocksize], pos[b:b+blocksize]
+    r_ij = r_b[None, :, :] - r_a[:, None, :]
+    r_ij -= box*cp.rint(r_ij/box)
+    mask = cp.sum(r_ij*r_ij, axis=-1) <= rmax**2
+    if a == b:
+        # Only count each pair once on diagonal tiles
+        idx = cp.arange(r_a.shape[0])
+        mask &= idx[:, None] < idx[None, :]
+    ii, jj = cp.nonzero(mask)
+    r_ij = r_ij[ii, jj].astype(float)
+    return (ii+a).astype(int), (jj+b).astype(int), r_ij
+
+
+def _get_bins(r, r_n, phi_m, theta_l, cos):
+    '''
+    Flattened (r, phi, theta) bin index of
+    displacements r, or -1 if outside the bins
+    '''
+    nr, nphi, ntheta = r_n.size-1, phi_m.size-1, theta_l.size-1
+    # Bin in the double precision of the edges
+    r = r.astype(cp.float64)
+    norm = cp.sqrt(cp.sum(r*r, axis=1))
+    # Pairs are within rmax, so keep those rounded past it
+    n = _bin(cp.minimum(norm, r_n[-1]), r_n)
+    m = _bin(cp.arctan2(r[:, 1], r[:, 0]), phi_m) if nphi > 1 else 0
+    if ntheta > 1:
+        # Clip to [-1, 1] against rounding
+        costheta = cp.clip(r[:, 2] / cp.where(norm > 0, norm, 1), -1, 1)
+        l = _bin(costheta if cos else cp.arccos(costheta), theta_l)
+        l = cp.where(norm > 0, l, -1)
+    else:
+        l = 0
+    inside = (n >= 0) & (m >= 0) & (l >= 0)
+    return cp.where(inside, (n*nphi + m)*ntheta + l, -1)
+
+
+def _bin(x, edges):
+    '''Index of x in uniform bins with edges, or -1 if outside'''
+    lo, hi, nbins = edges[0], edges[-1], edges.size-1
+    # Right edge belongs to the last bin
+    b = cp.minimum(((x - lo)*(nbins/(hi - lo))).astype(cp.int64), nbins-1)
+    return cp.where((x >= lo) & (x <= hi), b, -1)
+
+
+def _get_rotations(p):
+    '''
+    Coefficients (cos, sin, kx, ky) of the rotations
+    that align coords so that each vector p is in
+    the +z direction. In 3D, k is the axis of the
+    Rodrigues rotation formula.
+    '''
+    norm = cp.sqrt(cp.sum(p*p, axis=1))
+    # Angle of rotation is arccos(p . z). Don't rotate if p = 0.
+    cos = cp.where(norm > 0, p[:, -1] / cp.where(norm > 0, norm, 1), 1)
+    sin = cp.sqrt(cp.clip(1 - cos*cos, 0, None))
+    if p.shape[1] == 3:
+        # Rotation axis k = p x z, or any axis in the
+        # xy-plane if p is parallel to z
+        kn = cp.sqrt(p[:, 0]**2 + p[:, 1]**2)
+        safe = cp.where(kn > 0, kn, 1)
+        kx = cp.where(kn > 0, p[:, 1] / safe, 1)
+        ky = cp.where(kn > 0, -p[:, 0] / safe, 0)
+    else:
+        kx, ky = cp.zeros_like(cos), cp.zeros_like(cos)
+    return cp.stack([cos, sin, kx, ky], axis=1)
+
+
+def _rotate(R, r):
+    '''Rotate displacements r with coefficients R from _get_rotations'''
+    cos, sin, kx, ky = R[:, 0], R[:, 1], R[:, 2], R[:, 3]
+    x, y = r[:, 0], r[:, 1]
+    if r.shape[1] == 2:
+        return cp.stack([cos*x - sin*y, sin*x + cos*y], axis=1)
+    # R v = cos v + sin (k x v) + (1 - cos) k (k . v)
+    z = r[:, 2]
+    kv = (1 - cos)*(kx*x + ky*y)
+    return cp.stack([cos*x + sin*ky*z + kx*kv,
+                     cos*y - sin*kx*z + ky*kv,
+                     cos*z + sin*(kx*y - ky*x)], axis=1)
@@ -14,15 +14,20 @@ Adapted from https://github.com/wenyan4work/point_cloud.
 
 """
 
+import itertools
+import warnings
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import scipy.spatial as spatial
 import numba as nb
 from scipy.integrate import trapezoid
-from scipy.special import jv, spherical_jn, eval_legendre
+from scipy.fft import dst
+from scipy.special import j0, jv, spherical_jn, eval_legendre
 from time import time
 
 
-def fourier_multipoles(g_ell, poles, r, N, boxsize, dq=None, nq=None):
+def fourier_multipoles(g_ell, poles, r, N, boxsize, dq=None, nq=None,
+                       qblock=512, workers=None):
     r"""
     .. _fourier_multipoles:
 
@@ -74,6 +79,13 @@ def fourier_multipoles(g_ell, poles, r, N, boxsize, dq=None, nq=None):
         fundamental mode given by ``dq = np.pi / r.max()``.
     nq : `int`
         Number of :math:`q` bins. Default is ``r.size``.
+    qblock : `int`
+        Number of :math:`q` bins to integrate at once.
+        Bounds the size of the ``(qblock, nr)`` integrand.
+    workers : `int`
+        Number of threads integrating blocks of :math:`q`
+        when ``nq * nr`` exceeds ``2**20``. Default is
+        set by ``concurrent.futures.ThreadPoolExecutor``.
 
     Returns
     -------
@@ -95,27 +107,95 @@ def fourier_multipoles(g_ell, poles, r, N, boxsize, dq=None, nq=None):
     if ndim not in [2, 3]:
         raise ValueError("Dimension of box must be 2 or 3.")
 
-    def S(q, g_ell, ell):
-        if ndim == 3:
-            j_ell = spherical_jn(ell, q*r)
-            return 4*np.pi*rho*(-1.j)**ell*trapezoid(r**2*j_ell*g_ell, r)
-        else:
-            J_ell = jv(ell, q*r)
-            return 2*np.pi*rho*(-1.j)**ell*trapezoid(r*J_ell*g_ell, r)
-
-    s_ells = []
+    s_ells, quadrature = [], []
     for idx in range(len(ells)):
         g_l, l = g_ells[idx], ells[idx]
-        sq = np.zeros_like(q, dtype=np.complex128)
-        for jdx in range(nq):
-            sq[jdx] = S(q[jdx], g_l, l)
-        s_ells.append(sq)
+        if ndim == 3 and l == 0:
+            # Sine transform on commensurate grids
+            s0 = _dst_monopole(g_l, r, q)
+            if s0 is not None:
+                s_ells.append(4*np.pi*rho*s0.astype(np.complex128))
+                continue
+        s_ells.append(np.zeros_like(q, dtype=np.complex128))
+        quadrature.append(idx)
+
+    prefactor = 4*np.pi*rho if ndim == 3 else 2*np.pi*rho
+
+    def integrate(start):
+        # Evaluate integrands for a block of q at once
+        qr = np.multiply.outer(q[start:start+qblock], r)
+        for idx in quadrature:
+            g_l, l = g_ells[idx], ells[idx]
+            integrand = r**(ndim-1)*_bessel(l, qr, ndim)*g_l
+            s_ells[idx][start:start+qblock] = \
+                prefactor*(-1.j)**l*trapezoid(integrand, r, axis=1)
+            del integrand
+        del qr
+
+    if quadrature:
+        starts = range(0, q.size, qblock)
+        if q.size*r.size > 1 << 20:
+            # Ufuncs release the GIL, so use threads for large grids
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                list(executor.map(integrate, starts))
+        else:
+            for start in starts:
+                integrate(start)
 
     result = s_ells if type(poles) is list else s_ells[0]
 
     return result, q
 
 
+def _bessel(ell, x, ndim):
+    '''
+    Spherical Bessel function j_ell(x) in 3D and
+    Bessel function J_ell(x) in 2D, with direct
+    evaluation for ell = 0
+    '''
+    if ndim == 3:
+        return np.sinc(x/np.pi) if ell == 0 else spherical_jn(ell, x)
+    else:
+        return j0(x) if ell == 0 else jv(ell, x)
+
+
+def _dst_monopole(g, r, q):
+    '''
+    Trapezoid rule for the integral of r^2 j_0(qr) g(r)
+    computed with a type-I DST. Only applies if
+    r and q are uniform, start at zero, and dq*dr = pi/M
+    for integer M >= nr - 1. Returns None otherwise.
+    '''
+    nr, nq = r.size, q.size
+    if nr < 3 or nq < 2 or r[0] != 0 or q[0] != 0:
+        return None
+    dr, dq = r[1]-r[0], q[1]-q[0]
+    if not (np.allclose(np.diff(r), dr, rtol=1e-9, atol=0) and
+            np.allclose(np.diff(q), dq, rtol=1e-9, atol=0)):
+        return None
+    L = np.pi / (dq*dr)
+    M = int(np.rint(L))
+    if abs(L - M) > 1e-9*L or M < nr-1:
+        return None
+    # Sum of w_n r_n g_n sin(pi k n / M) for n = 1, ..., M-1
+    # with trapezoid weights w_n
+    h = dr*r*g
+    h[-1] *= 0.5
+    x = np.zeros(M-1, dtype=h.dtype)
+    n = min(nr, M) - 1
+    x[:n] = h[1:n+1]
+    X = 0.5*dst(x, type=1)
+    # Extend to all k using the odd, 2M-periodic symmetry in k
+    table = np.zeros(2*M, dtype=X.dtype)
+    table[1:M] = X
+    table[M+1:] = -X[::-1]
+    k = np.rint(q/dq).astype(np.int64)
+    s0 = np.empty(nq, dtype=X.dtype)
+    s0[1:] = table[k[1:] % (2*M)] / q[1:]
+    s0[0] = trapezoid(r**2*g, r)
+    return s0
+
+
 def multipoles(g, costheta, poles=0):
     r"""
     .. _multipoles:
@@ -162,8 +242,13 @@ def multipoles(g, costheta, poles=0):
     return result
 
 
+# Largest expected size in bytes of the pair index arrays
+# before corr counts g(r) with a dual-tree algorithm instead
+_pair_memory = 2**32
+
+
 def corr(positions, boxsize, weights=None, z=1, orientations=None, rmin=None, rmax=None,
-         nr=100, nphi=None, ntheta=None, cos=True, int=np.int32, float=np.float64,
+         nr=100, nphi=None, ntheta=None, cos=True, int=np.int32, float=np.float32,
          bench=False, **kwargs):
     """
     .. _corr:
@@ -200,6 +285,8 @@ def corr(positions, boxsize, weights=None, z=1, orientations=None, rmin=None, rm
     .. note::
         Reduces to the 1D radial distribution function :math:`g(r)`
         when ``nphi = None``, ``ntheta = None``, and ``weights = None``.
+        If storing the pairs for :math:`g(r)` would take more than
+        4 GiB, distances are instead binned by a slower dual-tree count.
 
     Parameters
     ----------
@@ -237,13 +324,18 @@ def corr(positions, boxsize, weights=None, z=1, orientations=None, rmin=None, rm
         Choose whether to bin in slices of :math:`\\cos\\theta`
         or :math:`\\theta`. Default is :math:`\\cos\\theta`.
     int : `np.dtype`, optional
-        Integer type for pair counting array.
-        Lets the user relax memory requirements.
+        Integer type for pair index arrays.
+        Lets the user relax memory requirements,
+        but must be able to index all :math:`N` particles.
     float : `np.dtype`, optional
-        Floating-point type for displacement buffers.
-        Lets the user relax memory requirements.
+        Floating-point type for computing pair displacements.
+        Differences of positions are taken in double precision,
+        so single precision only rounds the small displacements.
     bench : `bool`, optional
         Print message for time of calculation.
+    kwargs
+        Deprecated. Keyword arguments passed to ``np.histogramdd``,
+        which then bins all pair displacements in memory.
     Returns
     -------
     g : `np.ndarray`, shape `(nr, nphi, ntheta)`
@@ -268,6 +360,15 @@ def corr(positions, boxsize, weights=None, z=1, orientations=None, rmin=None, rm
     if ndim not in [2, 3]:
         raise ValueError("Dimension of space must be 2 or 3")
 
+    if kwargs:
+        msg = ("Passing keyword arguments to np.histogramdd through corr "
+               "is deprecated and will be removed in a future version")
+        warnings.warn(msg, DeprecationWarning, stacklevel=2)
+
+    if N > np.iinfo(int).max:
+        msg = f"Number of particles {N} overflows pair index type {np.dtype(int)}"
+        raise ValueError(msg)
+
     if orientations is not None:
         if orientations.shape != (N, ndim):
             msg = f"Shape of orientations must match positions array {(N, ndim)}"
@@ -287,20 +388,44 @@ def corr(positions, boxsize, weights=None, z=1, orientations=None, rmin=None, rm
     nr = 1 if nr is None or nr < 1 else nr
     nphi = 1 if nphi is None or nphi < 1 else nphi
     ntheta = 1 if ntheta is None or ntheta < 1 or ndim == 2 else ntheta
-    ncoords = 0
-    for n in [nr, nphi, ntheta]:
-        if n > 1:
-            ncoords += 1
 
-    # Periodic boundary conditions
-    _impose_pbc(positions, boxsize)
+    # Periodic boundary conditions. Pair displacements use the
+    # minimum image, so only wrap what cKDTree requires.
+    if positions.min() < 0 or np.any(positions >= boxsize):
+        np.mod(positions, boxsize, out=positions)
+        positions[positions == boxsize] = 0
+
+    # Bin edges
+    r_n = np.linspace(rmin, rmax, nr+1)
+    phi_m = 2*np.pi*np.linspace(0, 1, nphi+1) - np.pi
+    theta_l = np.linspace(-1, 1, ntheta+1) if cos else np.pi*np.linspace(0, 1, ntheta+1)
 
     if bench:
         t0 = time()
 
-    # Get particle pairs
-    pairs = _get_pairs(positions, boxsize, rmax, int)
-    npairs = len(pairs)
+    cells = _get_cell_list(positions, boxsize, rmax)
+
+    # Radial distribution function only depends on pair
+    # distances, which rotations leave unchanged.
+    radial = nphi == 1 and ntheta == 1 and not kwargs
+
+    if radial and cells is not None:
+        # Histogram pair distances while searching the cell list
+        args = (positions.astype(np.float64, copy=False),
+                weights.astype(float, copy=False), z,
+                boxsize.astype(np.float64), r_n)
+        count, npairs = _cell_list_counts(*args, *cells, nb.get_num_threads())
+    elif radial and weights.shape[0] == 1 and \
+            _pair_bytes(N, boxsize, rmax, int) > _pair_memory:
+        # Histogram pair distances with a dual-tree count, which
+        # is slower but doesn't store the pairs
+        count = _count_neighbors(positions, boxsize, r_n)
+        npairs = int(count.sum()) // 2
+    else:
+        # Get particle pairs
+        i_arr, j_arr = _get_pairs(positions, boxsize, rmax, int, cells)
+        npairs = i_arr.size
+        count = None
 
     if npairs == 0:
         raise ValueError(f"Counted 0 pairs. Try increasing rmax")
@@ -309,25 +434,25 @@ def corr(positions, boxsize, weights=None, z=1, orientations=None, rmin=None, rm
         t1 = time()
         print(f"Counted {npairs} pairs: {t1-t0:.04f} s")
 
-    # Get displacements
-    args = (positions, weights, z, orientations, boxsize,
-            rmax, nr, nphi, ntheta, cos)
-    rbuff = np.zeros((2*npairs, ncoords), dtype=float)
-    wbuff = np.zeros((2*npairs), dtype=float) if weights.shape[0] > 1 else np.zeros([0])
-    rij, wiwj = _get_displacements(rbuff, wbuff, pairs, *args)
+    if count is None:
+        # Bin displacements
+        rotations = _get_rotations(orientations.astype(float, copy=False))
+        args = (positions.astype(np.float64, copy=False),
+                weights.astype(float, copy=False), z, rotations,
+                boxsize.astype(np.float64),
+                r_n, phi_m, theta_l, cos)
+        if kwargs:
+            count = _histogram_displacements(i_arr, j_arr, *args, **kwargs)
+        else:
+            count = _get_displacements(i_arr, j_arr, *args)
 
     # Get correlation function
-    r_n = np.linspace(rmin, rmax, nr+1)
-    phi_m = 2*np.pi*np.linspace(0, 1, nphi+1) - np.pi
-    theta_l = np.linspace(-1, 1, ntheta+1) if cos else np.pi*np.linspace(0, 1, ntheta+1)
-    g, vol = _get_distribution(rij, wiwj, N, boxsize, r_n, phi_m, theta_l, cos, **kwargs)
+    g, vol = _get_distribution(count, N, boxsize, r_n, phi_m, theta_l, cos)
 
     if bench:
         t2 = time()
         print(f"Displacement calculation: {t2-t1:.04f} s")
 
-    del rij, wiwj, rbuff, pairs
-
     out = [g, r_n[:-1], phi_m[:-1]]
     if ndim == 3:
         out.append(theta_l[:-1])
@@ -336,173 +461,439 @@ def corr(positions, boxsize, weights=None, z=1, orientations=None, rmin=None, rm
     return tuple(out)
 
 
-def _get_distribution(rij, wiwj, N, boxsize, r_n, phi_m, theta_l, cos, **kwargs):
-    '''Generate pair correlation function'''
-    # Prepare arguments
-    bins = []
-    for b in [r_n, phi_m, theta_l]:
-        if b.size > 2:
-            bins.append(b)
-    # Bin
-    weights = wiwj if wiwj.size > 1 else None
-    count, edges = np.histogramdd(rij, bins=bins, weights=weights, **kwargs)
+def _get_distribution(count, N, boxsize, r_n, phi_m, theta_l, cos):
+    '''Generate pair correlation function from pair counts'''
     # Scale with bin volume and density
+    count = np.squeeze(count)
     ndim = boxsize.size
     density = N/(np.prod(boxsize))
-    vol = np.squeeze(_get_volume(count, r_n, phi_m, theta_l, ndim, cos))
+    vol = np.squeeze(_get_volume(r_n, phi_m, theta_l, ndim, cos))
     g = count/(N*vol*density)
     return g, vol
 
 
-@nb.njit(parallel=True, cache=True)
-def _get_volume(count, r, phi, theta, ndim, cos):
+def _pair_bytes(N, boxsize, rmax, int):
+    '''
+    Expected memory of the pair index arrays from _get_pairs
+    for uniformly distributed coords, including the (npairs, 2)
+    array of 64-bit indices returned by cKDTree
+    '''
+    ndim = boxsize.size
+    ball = np.pi*rmax**2 if ndim == 2 else 4/3*np.pi*rmax**3
+    npairs = N*(N-1)/2 * min(1., ball/np.prod(boxsize))
+    return npairs * (16 + 2*np.dtype(int).itemsize)
+
+
+def _count_neighbors(coords, boxsize, r):
+    '''Count ordered pairs (i != j) with distances in radial bins r'''
+    tree = spatial.cKDTree(coords, boxsize=boxsize)
+    # Bin 0 holds distances <= r[0], including self pairs
+    count = tree.count_neighbors(tree, r, cumulative=False)
+    return count[1:].astype(np.float64)
+
+
+def _get_volume(r, phi, theta, ndim, cos):
     '''Get volume elements for (r, phi, theta) bins'''
-    nr, nphi, ntheta = r.size-1, phi.size-1, theta.size-1
-    vol = np.zeros((nr, nphi, ntheta))
-    for n in nb.prange(nr):
-        dr = (r[n+1]**ndim-r[n]**ndim) / ndim
-        for m in range(nphi):
-            dphi = phi[m+1] - phi[m]
-            for l in range(ntheta):
-                vol[n, m, l] = dphi * dr
-                if ndim == 3:
-                    if cos:
-                        vol[n, m, l] *= theta[l+1] - theta[l]
-                    else:
-                        vol[n, m, l] *= np.cos(theta[l]) - np.cos(theta[l+1])
-    return vol
+    dr = (r[1:]**ndim - r[:-1]**ndim) / ndim
+    dphi = np.diff(phi)
+    if ndim == 3:
+        dtheta = np.diff(theta) if cos else np.cos(theta[:-1]) - np.cos(theta[1:])
+    else:
+        dtheta = np.ones(theta.size-1)
+    return dr[:, None, None] * dphi[None, :, None] * dtheta[None, None, :]
+
+
+_displacement_kernels = {}
 
 
-@nb.njit(parallel=True, cache=True)
-def _get_displacements(rbuff, wbuff, pairs, r, w, z, p, boxsize,
-                       rmax, nr, nphi, ntheta, cos):
-    '''Get displacements between pairs and correlation weights'''
-    rotate = True if p.shape == r.shape else False
-    nthreads = pairs.shape[0]
-    for idx1 in nb.prange(nthreads):
+def _get_displacements(i_arr, j_arr, r, w, z, rot, boxsize,
+                       r_n, phi_m, theta_l, cos):
+    '''
+    Bin displacements between pairs weighted by
+    correlation weights. Dispatches to a kernel
+    compiled for this combination of dimension,
+    rotation, weighting, and angular binning.
+    '''
+    key = (r.shape[1], rot.shape[0] == r.shape[0], w.shape == r.shape,
+           phi_m.size > 2, theta_l.size > 2, bool(cos))
+    if key not in _displacement_kernels:
+        _displacement_kernels[key] = _make_displacements(*key)
+    kernel = _displacement_kernels[key]
+    nchunks = nb.get_num_threads()
+    return kernel(i_arr, j_arr, r, w, z, rot, boxsize, r_n, phi_m, theta_l, nchunks)
+
+
+def _make_displacements(ndim, rotate, weigh, bin_phi, bin_theta, cos):
+    '''
+    Compile the pair loop for _get_displacements with
+    its options as constants, so that numba removes
+    the branches that don't apply.
+    '''
+    @nb.njit(parallel=True, cache=True, fastmath=True,
+             error_model='numpy', boundscheck=False)
+    def kernel(i_arr, j_arr, r, w, z, rot, boxsize, r_n, phi_m, theta_l, nchunks):
+        '''
+        Each of nchunks threads fills its own
+        histogram, which are summed at the end.
+        '''
+        nr, nphi, ntheta = r_n.size-1, phi_m.size-1, theta_l.size-1
+        inv_dr = nr / (r_n[-1] - r_n[0])
+        inv_dphi = nphi / (phi_m[-1] - phi_m[0])
+        inv_dtheta = ntheta / (theta_l[-1] - theta_l[0])
+        npairs = i_arr.size
+        size = (npairs + nchunks - 1) // nchunks
+        count = np.zeros((nchunks, nr, nphi, ntheta))
+        for c in nb.prange(nchunks):
+            for idx1 in range(c*size, min((c+1)*size, npairs)):
+                i, j = i_arr[idx1], j_arr[idx1]
+                # Get displacement vector with minimum image convention,
+                # then round to the working precision of rot
+                x_ij = rot.dtype.type(_wrap(r[j, 0] - r[i, 0], boxsize[0]))
+                y_ij = rot.dtype.type(_wrap(r[j, 1] - r[i, 1], boxsize[1]))
+                if ndim == 3:
+                    z_ij = rot.dtype.type(_wrap(r[j, 2] - r[i, 2], boxsize[2]))
+                else:
+                    z_ij = rot.dtype.type(0)
+                w_ij = _dot(w[i], w[j])**z if weigh else 1.
+                for idx2 in range(2):
+                    # Reverse pair (j, i) has displacement -r_ij
+                    if idx2 == 0:
+                        origin, x, y, z_o = i, x_ij, y_ij, z_ij
+                    else:
+                        origin, x, y, z_o = j, -x_ij, -y_ij, -z_ij
+                    if rotate:
+                        # Rotate particle head to +z direction
+                        x, y, z_o = _rotate(rot[origin], x, y, z_o, ndim)
+                    # Get bin indices in the double precision of the edges
+                    x, y, z_o = np.float64(x), np.float64(y), np.float64(z_o)
+                    norm = np.sqrt(x*x + y*y + z_o*z_o)
+                    # Pairs are within rmax, so keep those rounded past it
+                    n = _bin(min(norm, r_n[-1]), r_n[0], r_n[-1], inv_dr, nr)
+                    m, l = 0, 0
+                    if bin_phi:
+                        phi = np.arctan2(y, x)
+                        m = _bin(phi, phi_m[0], phi_m[-1], inv_dphi, nphi)
+                    if bin_theta:
+                        if norm > 0:
+                            # Clip to [-1, 1] against rounding
+                            costheta = min(max(z_o / norm, -1.), 1.)
+                            theta = costheta if cos else np.arccos(costheta)
+                            l = _bin(theta, theta_l[0], theta_l[-1], inv_dtheta, ntheta)
+                        else:
+                            l = -1
+                    if n >= 0 and m >= 0 and l >= 0:
+                        count[c, n, m, l] += w_ij
+        return count.sum(axis=0)
+
+    return kernel
+
+
+def _histogram_displacements(i_arr, j_arr, r, w, z, rot, boxsize,
+                             r_n, phi_m, theta_l, cos, **kwargs):
+    '''
+    Bin displacements between pairs weighted by
+    correlation weights with np.histogramdd, passing
+    through its keyword arguments
+    '''
+    bin_phi, bin_theta = phi_m.size > 2, theta_l.size > 2
+    bins = [r_n] + [phi_m]*bin_phi + [theta_l]*bin_theta
+    # Coords are compared to double precision bin edges
+    rbuff = np.zeros((2*i_arr.size, len(bins)), dtype=np.float64)
+    wbuff = np.zeros(2*i_arr.size if w.shape == r.shape else 0, dtype=w.dtype)
+    _fill_displacements(rbuff, wbuff, i_arr, j_arr, r, w, z, rot,
+                        boxsize, r_n, phi_m, theta_l, cos)
+    weights = wbuff if wbuff.size > 0 else None
+    count, edges = np.histogramdd(rbuff, bins=bins, weights=weights, **kwargs)
+    return count
+
+
+@nb.njit(parallel=True, cache=True, fastmath=True,
+         error_model='numpy', boundscheck=False)
+def _fill_displacements(rbuff, wbuff, i_arr, j_arr, r, w, z, rot,
+                        boxsize, r_n, phi_m, theta_l, cos):
+    '''
+    Fill buffers with the binned coordinates of displacements
+    between pairs and their correlation weights
+    '''
+    ndim = r.shape[1]
+    rotate = rot.shape[0] == r.shape[0]
+    bin_phi, bin_theta = phi_m.size > 2, theta_l.size > 2
+    npairs = i_arr.size
+    for idx1 in nb.prange(npairs):
+        i, j = i_arr[idx1], j_arr[idx1]
+        # Get displacement vector with minimum image convention,
+        # then round to the working precision of rot
+        x_ij = rot.dtype.type(_wrap(r[j, 0] - r[i, 0], boxsize[0]))
+        y_ij = rot.dtype.type(_wrap(r[j, 1] - r[i, 1], boxsize[1]))
+        if ndim == 3:
+            z_ij = rot.dtype.type(_wrap(r[j, 2] - r[i, 2], boxsize[2]))
+        else:
+            z_ij = rot.dtype.type(0)
         for idx2 in range(2):
-            pair = pairs[idx1]
-            index = idx1 + nthreads*idx2
-            i, j = pair if idx2 == 0 else pair[::-1]
-            # Get displacement vector
-            r_i, r_j = r[i], r[j]
-            r_ij = r_j - r_i
-            if _norm(r_ij) >= rmax:
-                # Fix periodic image
-                image = _closest_image(r_i, r_j, boxsize)
-                r_ij = image - r_i
+            # Reverse pair (j, i) has displacement -r_ij
+            index = idx1 + npairs*idx2
+            if idx2 == 0:
+                origin, x, y, z_o = i, x_ij, y_ij, z_ij
+            else:
+                origin, x, y, z_o = j, -x_ij, -y_ij, -z_ij
             if rotate:
                 # Rotate particle head to +z direction
-                p_i = p[i] / _norm(p[i])
-                R = _rotation_matrix(p_i)
-                r_ij = _matvec(R, r_ij)
-            # Fill buffers
-            if wbuff.size > 1:
+                x, y, z_o = _rotate(rot[origin], x, y, z_o, ndim)
+            if wbuff.size > 0:
                 wbuff[index] = _dot(w[i], w[j])**z
-            k = 0
-            norm = _norm(r_ij)
-            if nr > 1:
-                rbuff[index, k] = norm
-                k += 1
-            if nphi > 1:
-                rbuff[index, k] = np.arctan2(r_ij[1], r_ij[0])
+            # Get binned coords in the double precision of the edges
+            x, y, z_o = np.float64(x), np.float64(y), np.float64(z_o)
+            norm = np.sqrt(x*x + y*y + z_o*z_o)
+            # Pairs are within rmax, so keep those rounded past it
+            rbuff[index, 0] = min(norm, r_n[-1])
+            k = 1
+            if bin_phi:
+                rbuff[index, k] = np.arctan2(y, x)
                 k += 1
-            if ntheta > 1:
-                if cos:
-                    rbuff[index, k] = r_ij[2] / norm
+            if bin_theta:
+                if norm > 0:
+                    # Clip to [-1, 1] against rounding
+                    costheta = min(max(z_o / norm, -1.), 1.)
+                    rbuff[index, k] = costheta if cos else np.arccos(costheta)
                 else:
-                    rbuff[index, k] = np.arccos(r_ij[2] / norm)
-    return rbuff, wbuff
+                    # Coincident pairs have no angle and fall outside the bins
+                    rbuff[index, k] = theta_l[0] - 1
 
 
-@nb.njit(cache=True)
-def _rotation_matrix(p):
+@nb.njit(cache=True, fastmath=True,
+         error_model='numpy', boundscheck=False)
+def _wrap(d, L):
+    '''Minimum image of displacement d in a periodic length L'''
+    return d - L*np.rint(d/L)
+
+
+@nb.njit(cache=True, fastmath=True,
+         error_model='numpy', boundscheck=False)
+def _bin(x, lo, hi, inv, n):
+    '''Index of x in n uniform bins on [lo, hi], or -1 if outside'''
+    if not (x >= lo and x <= hi):
+        return -1
+    # Right edge belongs to the last bin
+    return min(int((x - lo)*inv), n-1)
+
+
+@nb.njit(parallel=True, cache=True, fastmath=True,
+         error_model='numpy', boundscheck=False)
+def _get_rotations(p):
     '''
-    Rotation matrix to align coords so that
-    a vector p is in the +z direction.
-    In 3D, use the Rodrigues rotation formula.
+    Coefficients (cos, sin, kx, ky) of the rotations
+    that align coords so that each vector p is in
+    the +z direction. In 3D, k is the axis of the
+    Rodrigues rotation formula.
     '''
-    # Angle of rotation is arccos(p . z)
-    cos, sin = p[-1], np.sin(np.arccos(p[-1]))
-    if p.size == 2:
-        R = np.array(((cos, -sin), (sin, cos)))
-    else:
-        # Rotation axis k = p x z
-        k = np.array([p[1], -p[0], 0])
-        k /= _norm(k)
-        # Cross product matrix K
-        K = np.array(((0, -k[2], k[1]),
-                      (k[2], 0, -k[0]),
-                      (-k[1], k[0], 0)))
-        # Matrix formulation of Rodrigues formula
-        R = np.eye(3) + sin*K + (1-cos)*_matmul(K, K)
-    return R
-
-
-def _get_pairs(coords, boxsize, rmax, int):
-    '''Get coordinate pairs within distance rmax'''
+    N, ndim = p.shape
+    rot = np.zeros((N, 4), dtype=p.dtype)
+    for i in nb.prange(N):
+        norm = _norm(p[i])
+        if norm == 0:
+            # No orientation, so don't rotate
+            rot[i, 0], rot[i, 2] = 1., 1.
+            continue
+        # Angle of rotation is arccos(p . z)
+        cos = p[i, -1] / norm
+        rot[i, 0] = cos
+        rot[i, 1] = np.sqrt(max(0., 1 - cos*cos))
+        if ndim == 3:
+            # Rotation axis k = p x z
+            kx, ky = p[i, 1], -p[i, 0]
+            kn = np.sqrt(kx*kx + ky*ky)
+            if kn > 0:
+                rot[i, 2], rot[i, 3] = kx/kn, ky/kn
+            else:
+                # p is parallel to z, so any axis in the xy-plane works
+                rot[i, 2], rot[i, 3] = 1., 0.
+    return rot
+
+
+@nb.njit(cache=True, fastmath=True,
+         error_model='numpy', boundscheck=False)
+def _rotate(R, x, y, z, ndim):
+    '''
+    Rotate coords (x, y, z) with coefficients R
+    from _get_rotations. In 2D, z is passed through.
+    '''
+    cos, sin = R[0], R[1]
+    if ndim == 2:
+        return cos*x - sin*y, sin*x + cos*y, z
+    # R v = cos v + sin (k x v) + (1 - cos) k (k . v)
+    kx, ky = R[2], R[3]
+    kv = (R.dtype.type(1) - cos)*(kx*x + ky*y)
+    return (cos*x + sin*ky*z + kx*kv,
+            cos*y - sin*kx*z + ky*kv,
+            cos*z + sin*(kx*y - ky*x))
+
+
+def _get_pairs(coords, boxsize, rmax, int, cells=None):
+    '''
+    Get coordinate pairs within distance rmax
+    as separate contiguous arrays of indices
+    '''
+    if cells is not None:
+        # Dense systems are faster with a cell list
+        return _get_cell_list_pairs(coords, boxsize, rmax, int, *cells)
     tree = spatial.cKDTree(coords, boxsize=boxsize)
     # Get unique pairs (i<j)
-    pairs = tree.query_pairs(r=rmax)
-    return np.array(list(pairs), dtype=int)
-
-
-@nb.njit(cache=True)
-def _impose_pbc(coords, boxsize):
-    '''Impose periodic boundary conditions for KDTree'''
-    dim = len(boxsize)
-    for j in range(len(coords)):
-        p = coords[j]
-        for i in range(dim):
-            while p[i] < 0:
-                p[i] = p[i]+boxsize[i]
-            while p[i] > boxsize[i]:
-                p[i] = p[i]-boxsize[i]
-
-
-@nb.njit(cache=True)
-def _closest_point(target, positions):
-    '''Get closest positions to target in 2D and 3D'''
-    target = np.array(target)
-    positions = np.array(positions)
-    distance = []
-    for p in positions:
-        distance.append(_norm(p-target))
-    distance = np.array(distance)
-    ind = np.argmin(distance)
-    return positions[ind], ind
-
-
-@nb.njit(cache=True)
-def _closest_point1d(target, positions):
-    '''Get closest positions to target in 1D'''
-    distance = []
-    for p in positions:
-        distance.append(np.abs(p-target))
-    distance = np.array(distance)
-    ind = np.argmin(distance)
-    return positions[ind], ind
-
-
-@nb.njit(cache=True)
-def _closest_image(target, source, boxsize):
-    '''Get closest periodic image to target'''
-    dim = target.shape[0]
-    assert source.shape[0] == dim
-    image = np.zeros(dim)
-    for i in range(dim):
-        pts = [source[i], source[i]-boxsize[i], source[i]+boxsize[i]]
-        pos, ind = _closest_point1d(target[i], pts)
-        image[i] = pos
-    return image
-
-
-@nb.njit(cache=True)
+    pairs = tree.query_pairs(r=rmax, output_type='ndarray')
+    i_arr = np.ascontiguousarray(pairs[:, 0], dtype=int)
+    j_arr = np.ascontiguousarray(pairs[:, 1], dtype=int)
+    return i_arr, j_arr
+
+
+def _get_cell_list(coords, boxsize, rmax):
+    '''
+    Bin particles into cells of side at least rmax/k.
+    Returns the number of cells per dimension, particle
+    indices sorted by cell, the start of each cell in
+    that order, and offsets to half of the neighbor cells
+    within k cells. Smaller cells search less volume
+    outside rmax, so dense systems use the largest k
+    whose cells hold more than 8 particles on average.
+    Returns None if the system is not dense enough to
+    benefit or there are too few cells for the stencil
+    to skip any of them.
+    '''
+    N, ndim = coords.shape
+    for k in (3, 2, 1):
+        ncell = np.floor(k * boxsize / rmax).astype(np.int64)
+        if np.all(ncell >= 2*k+2) and N / np.prod(ncell) > (8 if k > 1 else 4):
+            break
+    else:
+        return None
+    ncells = np.prod(ncell)
+    # Sort particles by cell
+    idx = np.minimum((coords * (ncell / boxsize)).astype(np.int64), ncell-1)
+    cell = np.ravel_multi_index(idx.T, ncell)
+    order = np.argsort(cell, kind='stable')
+    start = np.zeros(ncells+1, dtype=np.int64)
+    start[1:] = np.cumsum(np.bincount(cell, minlength=ncells))
+    # Neighbor offsets, with (0, ..., 0) first
+    steps = [0] + [s*x for x in range(1, k+1) for s in (1, -1)]
+    offsets = [o for o in itertools.product(steps, repeat=ndim)
+               if next((x for x in o if x != 0), 1) > 0]
+    offsets = np.array(offsets, dtype=np.int64)
+    return ncell, order, start, offsets
+
+
+def _get_cell_list_pairs(coords, boxsize, rmax, int, ncell, order, start, offsets):
+    '''
+    Get coordinate pairs within distance rmax by searching
+    each cell and half of its neighbors.
+    '''
+    ncells = start.size - 1
+    # Count pairs in each cell, then fill
+    args = (coords, boxsize, rmax**2, ncell, order, start, offsets)
+    npairs = np.zeros(ncells, dtype=np.int64)
+    i_arr, j_arr = np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+    _cell_list_pairs(*args, npairs, i_arr, j_arr, False)
+    cumulative = np.cumsum(npairs) - npairs
+    i_arr, j_arr = np.zeros(npairs.sum(), dtype=int), np.zeros(npairs.sum(), dtype=int)
+    _cell_list_pairs(*args, cumulative, i_arr, j_arr, True)
+    return i_arr, j_arr
+
+
+@nb.njit(parallel=True, cache=True, fastmath=True,
+         error_model='numpy', boundscheck=False)
+def _cell_list_pairs(coords, boxsize, rmax2, ncell, order, start, offsets,
+                     npairs, i_arr, j_arr, fill):
+    '''
+    Count pairs within each cell and its forward neighbors
+    into npairs, or if fill is True write them to i_arr
+    and j_arr starting at the offsets given by npairs.
+    '''
+    ncells = start.size - 1
+    for c in nb.prange(ncells):
+        n = npairs[c] if fill else 0
+        for o in range(offsets.shape[0]):
+            other = _neighbor_cell(c, offsets[o], ncell)
+            for a in range(start[c], start[c+1]):
+                i = order[a]
+                for b in range(a+1 if o == 0 else start[other], start[other+1]):
+                    j = order[b]
+                    if _distance2(coords, i, j, boxsize) <= rmax2:
+                        if fill:
+                            i_arr[n], j_arr[n] = i, j
+                        n += 1
+        if not fill:
+            npairs[c] = n
+
+
+@nb.njit(parallel=True, cache=True, fastmath=True,
+         error_model='numpy', boundscheck=False)
+def _cell_list_counts(coords, w, z, boxsize, r_n, ncell, order, start, offsets,
+                      nchunks):
+    '''
+    Bin distances between pairs within each cell and its
+    forward neighbors weighted by correlation weights,
+    without storing the pairs. Each of nchunks threads fills
+    its own histogram over a range of cells, which are summed
+    at the end. Also returns the number of pairs within
+    distance r_n[-1].
+    '''
+    weigh = True if w.shape == coords.shape else False
+    nr = r_n.size - 1
+    inv_dr = nr / (r_n[-1] - r_n[0])
+    rmax2 = r_n[-1]**2
+    ncells = start.size - 1
+    size = (ncells + nchunks - 1) // nchunks
+    count = np.zeros((nchunks, nr))
+    npairs = np.zeros(nchunks, dtype=np.int64)
+    for ch in nb.prange(nchunks):
+        for c in range(ch*size, min((ch+1)*size, ncells)):
+            for o in range(offsets.shape[0]):
+                other = _neighbor_cell(c, offsets[o], ncell)
+                for a in range(start[c], start[c+1]):
+                    i = order[a]
+                    for b in range(a+1 if o == 0 else start[other], start[other+1]):
+                        j = order[b]
+                        d2 = _distance2(coords, i, j, boxsize)
+                        if d2 <= rmax2:
+                            npairs[ch] += 1
+                            n = _bin(np.sqrt(d2), r_n[0], r_n[-1], inv_dr, nr)
+                            if n >= 0:
+                                # Count both (i, j) and (j, i)
+                                w_ij = _dot(w[i], w[j])**z if weigh else 1.
+                                count[ch, n] += 2*w_ij
+    return count.sum(axis=0), npairs.sum()
+
+
+@nb.njit(cache=True, fastmath=True,
+         error_model='numpy', boundscheck=False)
+def _neighbor_cell(c, offset, ncell):
+    '''Flat index of the periodic neighbor of cell c at offset'''
+    ndim = ncell.size
+    other, stride = 0, 1
+    for k in range(ndim-1, -1, -1):
+        idx = (c // stride) % ncell[k]
+        other += ((idx + offset[k]) % ncell[k]) * stride
+        stride *= ncell[k]
+    return other
+
+
+@nb.njit(cache=True, fastmath=True,
+         error_model='numpy', boundscheck=False)
+def _distance2(coords, i, j, boxsize):
+    '''Squared minimum image distance between coords i and j'''
+    d2 = 0.
+    for k in range(boxsize.size):
+        d = coords[j, k] - coords[i, k]
+        d -= boxsize[k]*np.rint(d/boxsize[k])
+        d2 += d*d
+    return d2
+
+
+@nb.njit(cache=True, fastmath=True,
+         error_model='numpy', boundscheck=False)
 def _norm(x):
     return np.sqrt(_dot(x, x))
 
 
-@nb.njit(cache=True)
+@nb.njit(cache=True, fastmath=True,
+         error_model='numpy', boundscheck=False)
 def _dot(a, b):
     dot = 0
     n = a.size
@@ -511,30 +902,19 @@ def _dot(a, b):
     return dot
 
 
-@nb.njit(cache=True)
-def _matvec(A, x):
-    b = np.zeros_like(x)
-    m, n = A.shape
-    for i in range(m):
-        b[i] = _dot(A[i, :], x[:])
-    return b
-
-
-@nb.njit(cache=True)
-def _matmul(A, B):
-    C = np.zeros_like(A)
-    m, n = A.shape
-    for i in range(m):
-        for j in range(n):
-            C[i, j] = _dot(A[i, :], B[:, j])
-    return C
-
-
 
 if __name__ == "__main__":
 
     from matplotlib import pyplot as plt
 
+    # Pairs of a lattice lie on bin edges, which single
+    # precision must bin the same as double precision
+    lattice = np.stack(np.meshgrid(*3*[np.arange(10.)]), axis=-1).reshape(-1, 3) + .5
+    kwargs = dict(rmax=1.5, nr=3, nphi=4, ntheta=4, cos=False)
+    g32 = corr(lattice.copy(), [10, 10, 10], float=np.float32, **kwargs)[0]
+    g64 = corr(lattice.copy(), [10, 10, 10], float=np.float64, **kwargs)[0]
+    assert np.array_equal(g32, g64)
+
     N = 1000
     boxsize = [50, 50, 50]
     np.random.seed(1234)